@@ -16,6 +16,10 @@ sys.path.append(os.path.dirname(__file__))
 
 from models import ResNet,WideResNet,EfficientNet,EfficientNetWithRatio,WideResNetWithMultiOutput,EMD
 
+tf.config.optimizer.set_jit('autoclustering')
+tf.keras.mixed_precision.set_global_policy('mixed_float16')
+
+
 class DataLoader(object):
     def __init__(self,file):
         df = pd.read_csv(file)
@@ -32,7 +36,7 @@ class DataLoader(object):
         self.test_size = self.x_test.shape[0]
         
             
-    def get_train_data(self):
+    def get_train_data(self,one_hot = True,shuffle = True):
         datas = list()
         targets = list()
         tmp = self.data_train[self.data_train['label'] == 0]
@@ -60,8 +64,51 @@ class DataLoader(object):
         
         datas = np.hstack(datas)
         targets = np.hstack(targets)
-        targets = np.identity(5)[targets]
-        return utils.shuffle(datas,targets)
+        if one_hot:
+            targets = np.identity(5)[targets]
+        if shuffle:
+            return utils.shuffle(datas,targets)
+        return datas,targets
+
+
+def write_tfrecord(
+    data_loader,
+    image_path,
+    save_path = './img_tfrec',
+    shard_size = 2000
+):
+    n_classes = data_loader.t_val.shape[1]
+    splits = {
+        'train': (data_loader.data_train['illust_id'].to_numpy(),data_loader.data_train['label'].to_numpy()),
+        'val': (data_loader.x_val,np.argmax(data_loader.t_val,axis = 1)),
+        'test': (data_loader.x_test,np.argmax(data_loader.t_test,axis = 1))
+    }
+    counts = dict()
+    for split,(ids,labels) in splits.items():
+        counts[split] = list()
+        for label in range(n_classes):
+            label_ids = utils.shuffle(ids[labels == label])
+            counts[split].append(int(label_ids.shape[0]))
+            label_path = save_path + '/' + split + '/' + str(label)
+            os.makedirs(label_path,exist_ok = True)
+            t = np.identity(n_classes)[label]
+            n_shards = (label_ids.shape[0] - 1) // shard_size + 1
+            for shard in tqdm(range(n_shards)):
+                start = shard * shard_size
+                end = min(start + shard_size,label_ids.shape[0])
+                path = label_path + '/part-{:05d}.tfrecord'.format(shard)
+                with tf.io.TFRecordWriter(path) as writer:
+                    for id in label_ids[start:end]:
+                        image = np.load(image_path + '/' + str(id) + '.npy').astype(np.uint8)
+                        feature = {
+                            'image': tf.train.Feature(bytes_list = tf.train.BytesList(value = [image.tobytes()])),
+                            'label': tf.train.Feature(float_list = tf.train.FloatList(value = t)),
+                            'id': tf.train.Feature(int64_list = tf.train.Int64List(value = [id]))
+                        }
+                        example = tf.train.Example(features = tf.train.Features(feature = feature))
+                        writer.write(example.SerializeToString())
+    with open(save_path + '/counts.json','w') as f:
+        json.dump(counts,f)
 
 
 class MnistTrainer(object):
@@ -72,25 +119,37 @@ class MnistTrainer(object):
         patience = 4,
         structure = 'wide_res_net',
     ):
-        self.model = None
-        if structure == 'wide_res_net':
-            self.model = WideResNet(
-                input_shape = input_shape,
-                output_dim = output_dim
+        self.strategy = tf.distribute.MirroredStrategy()
+        with self.strategy.scope():
+            self.model = None
+            if structure == 'wide_res_net':
+                self.model = WideResNet(
+                    input_shape = input_shape,
+                    output_dim = output_dim,
+                    logits = True
+                )
+            elif structure == 'res_net':
+                self.model = ResNet(
+                    input_shape = input_shape,
+                    output_dim = output_dim,
+                    logits = True
+                )
+            else:
+                raise Exception('no structure')
+            self.criterion = tf.keras.losses.SparseCategoricalCrossentropy(from_logits = True)
+            self.optimizer = tf.keras.mixed_precision.LossScaleOptimizer(
+                tf.keras.optimizers.SGD(
+                    learning_rate = 0.1,
+                    momentum = 0.9,
+                    nesterov = True
+                )
             )
-        elif structure == 'res_net':
-            self.model = ResNet(
-                input_shape = input_shape,
-                output_dim = output_dim
+            self.model.compile(
+                optimizer = self.optimizer,
+                loss = self.criterion,
+                metrics = ['accuracy'],
+                jit_compile = True
             )
-        else:
-            raise Exception('no structure')
-        self.criterion = tf.keras.losses.CategoricalCrossentropy()
-        self.optimizer = tf.keras.optimizers.SGD(learning_rate = 0.1)
-        self.train_loss = tf.keras.metrics.Mean()
-        self.train_acc = tf.keras.metrics.CategoricalAccuracy()
-        self.val_loss = tf.keras.metrics.Mean()
-        self.val_acc = tf.keras.metrics.CategoricalAccuracy()
         self.history = {
             'train_loss': [],
             'val_loss': [],
@@ -102,6 +161,10 @@ class MnistTrainer(object):
             'patience': patience,
             'step': 0
         }
+        self.checkpoint = tf.train.Checkpoint(self.model)
+        self.checkpoint_options = tf.train.CheckpointOptions(
+            experimental_enable_async_checkpoint = True
+        )
         self.save_dir = './logs'
         if not os.path.exists(self.save_dir):
             os.mkdir('logs')
@@ -111,51 +174,46 @@ class MnistTrainer(object):
         data_loader,
         epochs,
         batch_size,
-        early_stopping = False
+        early_stopping = False,
+        plot = False
     ):
-        
-        
-        n_batches_val = data_loader.val_size // batch_size
-        x_val = data_loader.x_val
-        t_val = data_loader.t_val
+        val_ds = tf.data.Dataset.from_tensor_slices(
+            (data_loader.x_val,np.argmax(data_loader.t_val,axis = 1))
+        ).batch(
+            batch_size,
+            drop_remainder = True
+        ).prefetch(tf.data.AUTOTUNE)
 
         for epoch in range(epochs):
-            x_,t_ = data_loader.get_train_data()
-            self.train_loss.reset_states()
-            self.val_loss.reset_states()
-            self.train_acc.reset_states()
-            self.val_acc.reset_states()
-            
-            for batch in tqdm(range(n_batches_train)):
-                start = batch * batch_size
-                end = start + batch_size
-                x_batch = x_[start:end]
-                t_batch = t_[start:end]
-                self.train_step(x_batch,t_batch)
-
-            for batch in tqdm(range(n_batches_val)):
-                start = batch * batch_size
-                end = start + batch_size
-                x_batch = x_val[start:end]
-                t_batch = t_val[start:end]
-                self.val_step(x_batch,t_batch)
-            
-            self.history['train_loss'].append(self.train_loss.result())
-            self.history['val_loss'].append(self.val_loss.result())
-            self.history['train_acc'].append(self.train_acc.result())
-            self.history['val_acc'].append(self.val_acc.result())
-            print('epoch {} => train_loss: {},  train_acc: {}, val_loss: {}, val_acc: {}'.format(
-                epoch + 1,
-                self.train_loss.result(),
-                self.train_acc.result(),
-                self.val_loss.result(),
-                self.val_acc.result()
-            ))
+            x_,t_ = data_loader.get_train_data(one_hot = False,shuffle = False)
+            train_ds = tf.data.Dataset.from_tensor_slices(
+                (x_,t_)
+            ).shuffle(x_.shape[0]).batch(
+                batch_size,
+                drop_remainder = True
+            ).prefetch(tf.data.AUTOTUNE)
+            his = self.model.fit(
+                train_ds,
+                epochs = epoch + 1,
+                initial_epoch = epoch,
+                validation_data = val_ds
+            )
+
+            val_loss = his.history['val_loss'][-1]
+            self.history['train_loss'].append(his.history['loss'][-1])
+            self.history['val_loss'].append(val_loss)
+            self.history['train_acc'].append(his.history['accuracy'][-1])
+            self.history['val_acc'].append(his.history['val_accuracy'][-1])
 
             if early_stopping:
-                if self.early_stopping(self.val_loss.result()):
+                if self.early_stopping(val_loss):
                     break
 
+        self.checkpoint.sync()
+        if plot:
+            self.plot()
+
+    def plot(self):
         fig = plt.figure(figsize = (20,20))
         ax1 = fig.add_subplot(2,2,1)
         ax2 = fig.add_subplot(2,2,2)
@@ -170,26 +228,14 @@ class MnistTrainer(object):
         ax3.set_title('val_loss')
         ax4.set_title('val_acc')
         plt.show()
-
-    def train_step(self,x,t):
-        with tf.GradientTape() as tape:
-            preds = self.model(x)
-            loss = self.criterion(t,preds)
-        grads = tape.gradient(loss,self.model.trainable_variables)
-        self.optimizer.apply_gradients(zip(grads,self.model.trainable_variables))
-        self.train_loss(loss)
-        self.train_acc(t,preds)
-
-    def val_step(self,x,t):
-        preds = self.model(x)
-        loss = self.criterion(t,preds)
-        self.val_loss(loss)
-        self.val_acc(t,preds)
+        plt.close(fig)
 
     def evaluate(self,x_test,t_test):
-        accuracy = tf.metrics.CategoricalAccuracy()
+        if t_test.ndim == 2:
+            t_test = np.argmax(t_test,axis = 1)
+        accuracy = tf.metrics.SparseCategoricalAccuracy()
         preds = self.model(x_test)
-        loss = self.criterion(preds,t_test)
+        loss = self.criterion(t_test,preds)
         accuracy(t_test,preds)
         print('accuracy: {}, loss: {}'.format(
             accuracy.result(),
@@ -199,10 +245,11 @@ class MnistTrainer(object):
 
     def save(self,name):
         path = self.save_dir +'/' + name
-        self.model.save_weights(path)
+        self.checkpoint.write(path,options = self.checkpoint_options)
     
     def load(self,name):
         path = self.save_dir +'/' + name
+        self.checkpoint.sync()
         self.model.load_weights(path)
 
     def early_stopping(self,loss):
@@ -231,31 +278,42 @@ class Trainer(object):
         loss = 'categorical_crossentropy',
         name = 'latest'
         ):
-        self.model = None
-        if structure == 'wide_res_net':
-            self.model = WideResNet(
-                input_shape = input_shape,
-                output_dim = output_dim
-            )
-        elif structure == 'res_net':
-            self.model = ResNet(
-                input_shape = input_shape,
-                output_dim = output_dim
+        self.strategy = tf.distribute.MirroredStrategy()
+        with self.strategy.scope():
+            self.model = None
+            if structure == 'wide_res_net':
+                self.model = WideResNet(
+                    input_shape = input_shape,
+                    output_dim = output_dim,
+                    rescale = 1. / 255
+                )
+            elif structure == 'res_net':
+                self.model = ResNet(
+                    input_shape = input_shape,
+                    output_dim = output_dim,
+                    rescale = 1. / 255
+                )
+            else:
+                raise Exception('no structure')
+            self.input_shape = input_shape
+            self.output_dim = output_dim
+            if loss == 'categorical_crossentropy':
+                self.criterion = tf.keras.losses.CategoricalCrossentropy()
+            elif loss == 'emd':
+                self.criterion = EMD
+            self.optimizer = tf.keras.mixed_precision.LossScaleOptimizer(
+                tf.keras.optimizers.SGD(
+                    learning_rate = 0.1,
+                    momentum = 0.9,
+                    nesterov = True
+                )
             )
-        else:
-            raise Exception('no structure')
-        if loss == 'categorical_crossentropy':
-            self.criterion = tf.keras.losses.CategoricalCrossentropy() 
-        elif loss == 'emd':
-            self.criterion = EMD
-        self.optimizer = tf.keras.optimizers.SGD(
-            learning_rate = 0.1,
-            momentum = 0.1
+            self.model.compile(
+                optimizer = self.optimizer,
+                loss = self.criterion,
+                metrics = ['accuracy'],
+                jit_compile = True
             )
-        self.train_acc = tf.keras.metrics.CategoricalAccuracy()
-        self.train_loss = tf.keras.metrics.Mean()
-        self.val_acc = tf.keras.metrics.CategoricalAccuracy()
-        self.val_loss = tf.keras.metrics.Mean()
         self.history = {
             'train_acc': [],
             'train_loss': [],
@@ -268,6 +326,11 @@ class Trainer(object):
             'patience': patience,
             'step': 0
         }
+        self.checkpoint = tf.train.Checkpoint(self.model)
+        self.checkpoint_options = tf.train.CheckpointOptions(
+            experimental_enable_async_checkpoint = True
+        )
+        self.pending = None
         self.save_dir = './logs'
         if not os.path.exists(self.save_dir):
             os.mkdir('logs')
@@ -276,118 +339,131 @@ class Trainer(object):
 
     def train(
         self,
-        data_loader,
         epochs,
         batch_size,
-        image_path,
-        early_stopping = False
+        record_path = './img_tfrec',
+        class_size = 20000,
+        early_stopping = False,
+        plot = False
     ):
-        n_batches_val = data_loader.val_size // batch_size
-        x_val = data_loader.x_val
-        t_val = data_loader.t_val
+        val_ds = self.get_dataset(
+            record_path,
+            'val',
+            batch_size,
+            cache = True
+        )
+        train_ds = self.get_dataset(
+            record_path,
+            'train',
+            batch_size,
+            class_size = class_size,
+            drop_remainder = True
+        )
         start = self.history['start']
 
 
         for epoch in range(start,epochs):
             self.history['start'] = epoch
-            x_,t_ = data_loader.get_train_data()
-            n_batches_train = x_.shape[0] // batch_size
-            self.train_acc.reset_states()
-            self.train_loss.reset_states()
-            self.val_acc.reset_states()
-            self.val_loss.reset_states()
-            
-            for batch in tqdm(range(n_batches_train)):
-                start = batch * batch_size
-                end = start + batch_size
-                x_batch = x_[start:end]
-                t_batch = t_[start:end]
-                img_batch = self.get_image(image_path,x_batch)
-                self.train_step(img_batch,t_batch)
-
-
-            for batch in tqdm(range(n_batches_val + 1)):
-                start = batch * batch_size
-                end = start + batch_size
-                end = min(end,x_val.shape[0])
-                x_batch = x_val[start:end]
-                t_batch = t_val[start:end]
-                img_batch = self.get_image(image_path,x_batch)
-                self.val_step(img_batch,t_batch)
-            
-            self.history['train_loss'].append(self.train_loss.result().numpy())
-            self.history['val_loss'].append(self.val_loss.result().numpy())
-            self.history['train_acc'].append(self.train_acc.result().numpy())
-            self.history['val_acc'].append(self.val_acc.result().numpy())
-            print('epoch {} => train_loss: {},  train_acc: {}, val_loss: {}, val_acc: {}'.format(
-                epoch + 1,
-                self.train_loss.result(),
-                self.train_acc.result(),
-                self.val_loss.result(),
-                self.val_acc.result()
-            ))
-
-
-            if self.early_stopping(self.val_loss.result()):
+            his = self.model.fit(
+                train_ds,
+                epochs = epoch + 1,
+                initial_epoch = epoch,
+                validation_data = val_ds
+            )
+
+            val_loss = his.history['val_loss'][-1]
+            self.history['train_loss'].append(his.history['loss'][-1])
+            self.history['val_loss'].append(val_loss)
+            self.history['train_acc'].append(his.history['accuracy'][-1])
+            self.history['val_acc'].append(his.history['val_accuracy'][-1])
+
+            if self.early_stopping(val_loss):
                 if early_stopping:
                     break
             self.save(self.name)
 
-        self.plot()
+        self.flush()
+        if plot:
+            self.plot()
 
 
 
 
-    def get_image(
+    def read_records(
         self,
-        image_path,
-        x_batch,
-        standard = 255
+        pattern,
+        shuffle = False,
+        shuffle_buffer = 10000
     ):
-        img_batch = list()
-        for id in x_batch:
-            image = np.load(image_path + '/' + str(id) + '.npy')
-            img_batch.append(image/standard)
-            
-        return np.array(img_batch)
-
-    def train_step(self,x,t):
-        with tf.GradientTape() as tape:
-            preds = self.model(x)
-            loss = self.criterion(t,preds)
-        grads = tape.gradient(loss,self.model.trainable_variables)
-        self.optimizer.apply_gradients(zip(grads,self.model.trainable_variables))
-        self.train_loss(loss)
-        self.train_acc(t,preds)
-
-    def val_step(self,x,t):
-        preds = self.model(x)
-        loss = self.criterion(t,preds)
-        self.val_loss(loss)
-        self.val_acc(t,preds)
-
-    def evaluate(self,x_test,t_test,batch_size = 1000):
+        feature_description = {
+            'image': tf.io.FixedLenFeature([],tf.string),
+            'label': tf.io.FixedLenFeature([self.output_dim],tf.float32)
+        }
+
+        def decode(record):
+            example = tf.io.parse_single_example(record,feature_description)
+            image = tf.io.decode_raw(example['image'],tf.uint8)
+            image = tf.reshape(image,self.input_shape)
+            return image,example['label']
+
+        files = tf.data.Dataset.list_files(pattern,shuffle = shuffle)
+        ds = files.interleave(
+            tf.data.TFRecordDataset,
+            cycle_length = 8,
+            num_parallel_calls = tf.data.AUTOTUNE,
+            deterministic = False
+        )
+        if shuffle:
+            ds = ds.shuffle(shuffle_buffer)
+        ds = ds.map(
+            decode,
+            num_parallel_calls = tf.data.AUTOTUNE
+        )
+        return ds
+
+    def get_dataset(
+        self,
+        record_path,
+        split,
+        batch_size,
+        class_size = None,
+        drop_remainder = False,
+        cache = False
+    ):
+        if class_size is None:
+            ds = self.read_records(record_path + '/' + split + '/*/*.tfrecord')
+        else:
+            with open(record_path + '/counts.json','r') as f:
+                counts = json.loads(f.read())[split]
+            datasets = list()
+            sizes = list()
+            for label,count in enumerate(counts):
+                if count == 0:
+                    continue
+                size = min(count,class_size)
+                pattern = record_path + '/' + split + '/' + str(label) + '/*.tfrecord'
+                datasets.append(self.read_records(pattern,shuffle = True).take(size))
+                sizes.append(size)
+            ds = tf.data.Dataset.sample_from_datasets(
+                datasets,
+                weights = [size / sum(sizes) for size in sizes]
+            )
+        if cache:
+            ds = ds.cache()
+        ds = ds.batch(
+            batch_size,
+            drop_remainder = drop_remainder
+        ).prefetch(tf.data.AUTOTUNE)
+        return ds
+
+    def evaluate(self,record_path = './img_tfrec',batch_size = 1000):
         loss = tf.keras.metrics.Mean()
         accuracy = tf.keras.metrics.CategoricalAccuracy()
-        n_batches = x_test.shape[0] // batch_size
-        for batch in tqdm(range(n_batches)):
-            start = batch_size * batch
-            end = start + batch_size
-            x_batch = x_test[start:end]
-            t_batch = t_test[start:end]
-            img_batch = self.get_image(x_batch)
+        test_ds = self.get_dataset(record_path,'test',batch_size)
+        for img_batch,t_batch in tqdm(test_ds):
             preds = self.model(img_batch)
             loss(self.criterion(t_batch,preds))
             accuracy(t_batch,preds)
-
-        start = batch_size * n_batches
-        end = x_test.shape[0]
-        x_batch = x_test[start:end]
-        t_batch = t_test[start:end]
-        img_batch = self.get_image(x_batch)
-        preds = self.model(img_batch)
-        loss(self.criterion(t_batch,preds))
-        accuracy(t_batch,preds)
         print('loss: {}, accuracy: {}'.format(
             loss.result(),
             accuracy.result()
@@ -396,36 +472,44 @@ class Trainer(object):
         return (loss.result().numpy(),accuracy.result().numpy())
 
     def early_stopping(self,loss):
-        name = self.name + '_es'
         if loss > self.es['loss']:
             self.es['step'] += 1
             if self.es['step'] > self.es['patience']:
                 print('early stopping')
                 return True
         else:
-            self.es['loss'] = loss
+            self.es['loss'] = float(loss)
             self.es['step'] = 0
-            self.save(name)
+            self.save(self.name + '_es')
 
         return False
 
     def save(self,name):
+        self.flush()
         path = self.save_dir +'/' + name
-        self.model.save_weights(path)
+        self.checkpoint.write(path,options = self.checkpoint_options)
         dic = {
             'history': self.history,
             'es': self.es
         }
-        with open(self.save_dir + '/' + name + '.json','w') as f:
-            json.dump(dic,f)
+        self.pending = (name,json.dumps(dic))
+
+    def flush(self):
+        self.checkpoint.sync()
+        if self.pending is not None:
+            name,data = self.pending
+            with open(self.save_dir + '/' + name + '.json','w') as f:
+                f.write(data)
+            self.pending = None
         
     def load(self,name):
         path = self.save_dir +'/' + name
+        self.flush()
         self.model.load_weights(path)
         with open(self.save_dir + '/' + name + '.json','r') as f:
             data = f.read()
-        dic = json.load(data)
-        self.hisotory = dic['history']
+        dic = json.loads(data)
+        self.history = dic['history']
         self.es = dic['es']
 
     def plot(self):
@@ -443,6 +527,7 @@ class Trainer(object):
         ax3.set_title('val_loss')
         ax4.set_title('val_acc')
         plt.show()
+        plt.close(fig)
     
 class TrainerV2(object):
     def __init__(
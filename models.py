@@ -130,6 +130,8 @@ class ResNet(Model):
         self,
         input_shape,
         output_dim,
+        rescale = None,
+        logits = False,
     ):
         super().__init__()
         self._layers = [
@@ -166,10 +168,15 @@ class ResNet(Model):
             ],
             kl.GlobalAveragePooling2D(),
             kl.Dense(1000,activation="relu"),
-            kl.Dense(output_dim,activation = 'softmax')
+            kl.Dense(output_dim,activation = None if logits else 'softmax',dtype = 'float32')
         ]
+        self.rescale = None
+        if rescale is not None:
+            self.rescale = kl.Rescaling(rescale)
 
     def call(self,x):
+        if self.rescale is not None:
+            x = self.rescale(x)
         for layer in self._layers:
             if isinstance(layer,list):
                 for l in layer:
@@ -183,6 +190,8 @@ class WideResNet(Model):
         self,
         input_shape,
         output_dim,
+        rescale = None,
+        logits = False,
     ):
         super().__init__()
         self._layers = [
@@ -221,10 +230,15 @@ class WideResNet(Model):
             ],
             kl.GlobalAveragePooling2D(),
             kl.Dense(1000,activation = 'relu'),
-            kl.Dense(output_dim,activation = 'softmax')
+            kl.Dense(output_dim,activation = None if logits else 'softmax',dtype = 'float32')
         ]
+        self.rescale = None
+        if rescale is not None:
+            self.rescale = kl.Rescaling(rescale)
         
     def call(self,x):
+        if self.rescale is not None:
+            x = self.rescale(x)
         for layer in self._layers:
             if isinstance(layer,list):
                 for l in layer:
@@ -295,9 +309,9 @@ def WideResNetWithMultiOutput(
     wide_res_net = WideResNetForMultiOutput(input_shape)
     _ = wide_res_net(input_layer)
     bookmark_encode = kl.Dense(1000,activation = 'relu')(_)
-    bookmark_output = kl.Dense(output_dim,activation = 'softmax',name = 'bookmark')(bookmark_encode)
+    bookmark_output = kl.Dense(output_dim,activation = 'softmax',dtype = 'float32',name = 'bookmark')(bookmark_encode)
     aspect_ratio_encode = kl.Dense(500,activation = 'relu')(_)
-    aspect_ratio_output = kl.Dense(1,activation = 'sigmoid',name = 'aspect_ratio')(aspect_ratio_encode)
+    aspect_ratio_output = kl.Dense(1,activation = 'sigmoid',dtype = 'float32',name = 'aspect_ratio')(aspect_ratio_encode)
     outputs = [bookmark_output,aspect_ratio_output]
     model = Model(inputs = input_layer,outputs = outputs)
 
@@ -326,7 +340,7 @@ def EfficientNetWithRatio(
     ratio_out = kl.Dense(5,activation = 'linear')(input2)
     _ = kl.concatenate([pool_out,ratio_out])
     _ = kl.Dense(encode_dim,activation = 'relu')(_)
-    outputs = kl.Dense(output_dim,activation = 'softmax')(_)
+    outputs = kl.Dense(output_dim,activation = 'softmax',dtype = 'float32')(_)
 
     model = Model(inputs = [input1,input2],outputs = outputs)
 
@@ -356,7 +370,7 @@ def EfficientNet(
     _ = kl.GlobalAveragePooling2D()(bottleneck)
 
     _ = kl.Dense(encode_dim,activation = 'relu')(_)
-    bookmark_output = kl.Dense(output_dim,activation = 'softmax',name = 'bookmark')(_)
+    bookmark_output = kl.Dense(output_dim,activation = 'softmax',dtype = 'float32',name = 'bookmark')(_)
 
     #_ = kl.Dense(1000,activvation = 'relu')(bottleneck)
     #aspect_ratio_output = kl.Dense(2,activation = 'softmax',name = 'aspect_ratio')(_)
@@ -384,10 +398,10 @@ def EfficientNetWithMultiOutput(
     bottleneck = efficient_net.output
 
     _ = kl.Dense(1000,activation = 'relu')(bottleneck)
-    bookmark_output = kl.Dense(output_dim,activation = 'softmax',name = 'bookmark')(_)
+    bookmark_output = kl.Dense(output_dim,activation = 'softmax',dtype = 'float32',name = 'bookmark')(_)
 
     _ = kl.Dense(1000,activvation = 'relu')(bottleneck)
-    aspect_ratio_output = kl.Dense(2,activation = 'softmax',name = 'aspect_ratio')(_)
+    aspect_ratio_output = kl.Dense(2,activation = 'softmax',dtype = 'float32',name = 'aspect_ratio')(_)
 
     model = Model(inputs = input_layer,outputs = [bookmark_output,aspect_ratio_output])
 
@@ -396,6 +410,6 @@ def EfficientNetWithMultiOutput(
 
 
 def EMD(t,preds):
-    return tf.reduce_mean(tf.reduce_sum(tf.math.cumsum(preds-t,axis = 1)**2,axis = 1))
+    return tf.reduce_sum(tf.math.cumsum(preds-t,axis = 1)**2,axis = 1)
 
     